@@ -1,3 +1,6 @@
+from contextlib import nullcontext
+from functools import lru_cache
+import importlib.util
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,11 +8,30 @@ import math
 from torch import Tensor
 from typing import List, Tuple
 
+# Above this number of scores per sample (m * s), PSN selects the grouped points by KeOps
+# instead of materializing the scores, if pykeops is installed.
+KEOPS_MIN_SCORES = 2 ** 26
+
+
+class ChannelsLastBN1d(nn.BatchNorm1d):
+    """
+    BatchNorm1d applied on the last dimension of a Channel Last input [B, m, C].
+    Parameters and running statistics are those of BatchNorm1d, so checkpoints are interchangeable.
+    """
+
+    def forward(self, input: Tensor) -> Tensor:
+        # Flattening [B, m, C] to [B*m, C] normalizes each channel over the same B*m
+        # values as BatchNorm1d does on [B, C, m], without transposing.
+        shape = input.shape
+        return super(ChannelsLastBN1d, self).forward(input.reshape(-1, shape[-1])).view(shape)
+
 
 class PSNv1(nn.Module):
     """
     Point Structuring Net PyTorch Module.
     PSNet version 1, MLP implemented by 1x1 convolution.
+    The 1x1 convolutions are computed as Linear with bias on Channel Last data,
+    which is numerically the same and loads the weights of 1x1 convolution.
 
     Attributes:
         num_to_sample: the number to sample, int
@@ -30,30 +52,38 @@ class PSNv1(nn.Module):
         assert len(mlp) > 1, "The number of MLP layers must greater than 1 !"
 
         self.mlp_convs.append(
-            nn.Conv1d(in_channels=5, out_channels=mlp[0], kernel_size=1))
-        self.mlp_bns.append(nn.BatchNorm1d(num_features=mlp[0]))
+            nn.Linear(in_features=5, out_features=mlp[0], bias=True))
+        self.mlp_bns.append(ChannelsLastBN1d(num_features=mlp[0]))
 
         for i in range(len(mlp)-1):
             self.mlp_convs.append(
-                nn.Conv1d(in_channels=mlp[i], out_channels=mlp[i+1], kernel_size=1))
+                nn.Linear(in_features=mlp[i], out_features=mlp[i+1], bias=True))
 
         for i in range(len(mlp)-1):
-            self.mlp_bns.append(nn.BatchNorm1d(num_features=mlp[i+1]))
+            self.mlp_bns.append(ChannelsLastBN1d(num_features=mlp[i+1]))
 
         self.global_feature = global_feature
 
         if self.global_feature:
             self.mlp_convs.append(
-                nn.Conv1d(in_channels=mlp[-1] * 2, out_channels=num_to_sample, kernel_size=1))
+                nn.Linear(in_features=mlp[-1] * 2, out_features=num_to_sample, bias=True))
         else:
             self.mlp_convs.append(
-                nn.Conv1d(in_channels=mlp[-1], out_channels=num_to_sample, kernel_size=1))
+                nn.Linear(in_features=mlp[-1], out_features=num_to_sample, bias=True))
 
         self.s = num_to_sample
         self.n = max_local_num
         self.temperature = 0.1
-        self.origin_point = torch.nn.Parameter(
-            torch.zeros(1, 3), requires_grad=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before origin_point was removed still carry it.
+        state_dict.pop(prefix + 'origin_point', None)
+        # Checkpoints saved with 1x1 convolution store the weights as [out, in, 1].
+        for i in range(len(self.mlp_convs)):
+            key = prefix + 'mlp_convs.%d.weight' % i
+            if key in state_dict and state_dict[key].dim() == 3:
+                state_dict[key] = state_dict[key].squeeze(2)
+        super(PSNv1, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, coordinate: Tensor, feature: Tensor, train: bool = False) -> Tuple[Tensor, Tensor]:
         """
@@ -70,28 +100,22 @@ class PSNv1(nn.Module):
 
         assert self.s < m, "The number to sample must less than input points !"
 
-        r = torch.cdist(coordinate, self.origin_point, 2).squeeze_()
-        th = torch.acos(coordinate[:, :, 2] / r)
-        fi = torch.atan2(coordinate[:, :, 1], coordinate[:, :, 0])
+        coordinate2 = spherical_augment(coordinate)  # [B, m, 5]
 
-        coordinate2 = torch.cat(
-            [coordinate, th.unsqueeze_(2), fi.unsqueeze_(2)], -1)
-
-        x = coordinate2.transpose(2, 1)  # Channel First [B, 5, m]
+        x = coordinate2  # Channel Last [B, m, 5]
 
         for i in range(len(self.mlp_convs) - 1):
             x = F.relu(self.mlp_bns[i](self.mlp_convs[i](x)))
 
         if self.global_feature:
-            max_feature = torch.max(x, 2, keepdim=True)[0]
-            max_feature = max_feature.repeat(1, 1, m)   # [B, mlp[-1], m]
-            x = torch.cat([x, max_feature], 1)  # [B, mlp[-1] * 2, m]
-
-        x = self.mlp_convs[-1](x)   # [B,s,m]
-
-        Q = torch.sigmoid(x)  # [B, s, m]
+            # The max feature is added once per channel instead of repeated m times
+            x = linear_with_global_feature(self.mlp_convs[-1], x).transpose(1, 2)   # [B,s,m]
+        else:
+            x = self.mlp_convs[-1](x).transpose(1, 2)   # [B,s,m]
 
-        _, grouped_indices = torch.topk(input=Q, k=self.n, dim=2)    # [B, s, n]
+        # Sigmoid is monotonic, so topk on the raw scores picks the same indices.
+        grouped_scores, grouped_indices = torch.topk(input=x, k=self.n, dim=2)    # [B, s, n]
+        Q = x  # [B, s, m] sigmoid is only applied for gumbel softmax
         grouped_points = index_points(coordinate, grouped_indices)  # [B,s,n,3]
         if feature is not None:
             grouped_feature = index_points(feature, grouped_indices)  # [B,s,n,d]
@@ -99,20 +123,20 @@ class PSNv1(nn.Module):
                 sampled_points = grouped_points[:, :, 0, :]  # [B,s,3]
                 sampled_feature = grouped_feature[:, :, 0, :]  # [B,s,d]
             else:
-                # Q = gumbel_softmax_sample(Q)  # [B, s, m]
-                # [B, s, m] Using the Gumbel Softmax function included in PyTorch
-                Q = F.gumbel_softmax(Q, self.temperature, True)
-                sampled_points = torch.matmul(Q, coordinate)  # [B,s,3]
-                sampled_feature = torch.matmul(Q, feature)  # [B,s,d]
-                grouped_feature[:, :, 0, :] = sampled_feature
+                # Gumbel softmax restricted to the n candidates of every sampled point,
+                # the hard one-hot is applied by straight_through_gather
+                W = F.gumbel_softmax(torch.sigmoid(grouped_scores), self.temperature)  # [B, s, n]
+                sampled_points = straight_through_gather(W, grouped_points)  # [B,s,3]
+                sampled_feature = straight_through_gather(W, grouped_feature)  # [B,s,d]
+                # grouped_feature is not written in place, sampled_feature was gathered from it
+                grouped_feature = torch.cat([sampled_feature.unsqueeze(2), grouped_feature[:, :, 1:, :]], 2)
         else:
             if not train:
                 sampled_points = grouped_points[:, :, 0, :]  # [B,s,3]
                 sampled_feature = None  # [B,s,d]
             else:
-                # Q = gumbel_softmax_sample(Q)  # [B, s, m]
-                Q = F.gumbel_softmax(Q, self.temperature, True)  # [B, s, m]
-                sampled_points = torch.matmul(Q, coordinate)  # [B,s,3]
+                W = F.gumbel_softmax(torch.sigmoid(grouped_scores), self.temperature)  # [B, s, n]
+                sampled_points = straight_through_gather(W, grouped_points)  # [B,s,3]
                 sampled_feature = None
             grouped_feature = None
 
@@ -131,6 +155,8 @@ class PSN(nn.Module):
         max_local_num: the max number of local area, int
         mlp: the channels of feature transform function, List[int]
         global_geature: whether enable global feature, bool
+        debug: whether report the ratio of unique grouped points, bool
+        mixed_precision: whether run the MLP in bfloat16 on the device of the input, requires PyTorch 1.10, bool
     """
 
     def __init__(self, num_to_sample: int = 512, max_local_num: int = 32, mlp: List[int] = [32, 128], global_feature: bool = False) -> None:
@@ -146,14 +172,14 @@ class PSN(nn.Module):
 
         self.mlp_convs.append(
             nn.Linear(in_features=5, out_features=mlp[0], bias=False))
-        self.mlp_bns.append(nn.BatchNorm1d(num_features=mlp[0]))
+        self.mlp_bns.append(ChannelsLastBN1d(num_features=mlp[0]))
 
         for i in range(len(mlp)-1):
             self.mlp_convs.append(
                 nn.Linear(in_features=mlp[i], out_features=mlp[i+1], bias=False))
 
         for i in range(len(mlp)-1):
-            self.mlp_bns.append(nn.BatchNorm1d(num_features=mlp[i+1]))
+            self.mlp_bns.append(ChannelsLastBN1d(num_features=mlp[i+1]))
 
         self.global_feature = global_feature
 
@@ -167,8 +193,39 @@ class PSN(nn.Module):
         self.s = num_to_sample
         self.n = max_local_num
         self.temperature = 0.1
-        self.origin_point = torch.nn.Parameter(
-            torch.zeros(1, 3), requires_grad=False)
+        self.debug = False
+        self.mixed_precision = False
+        self._eager_keys = set()
+        self._reset_graph()
+
+    def _reset_graph(self) -> None:
+        """
+        Drop the CUDA graph of forward_graphed and its static tensors, it is captured again at the next call.
+        """
+        self._graph = None
+        self._graph_key = None
+        self._static_coordinate = None
+        self._static_feature = None
+        self._static_output = None
+
+    def __getstate__(self):
+        # A CUDA graph cannot be pickled, and a deepcopy must not replay the graph of the original weights.
+        state = super(PSN, self).__getstate__().copy()
+        for name in ("_graph", "_graph_key", "_static_coordinate", "_static_feature", "_static_output"):
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        super(PSN, self).__setstate__(state)
+        # Models pickled before forward_compiled and forward_graphed have none of their state.
+        if "_eager_keys" not in self.__dict__:
+            self._eager_keys = set()
+        self._reset_graph()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before origin_point was removed still carry it.
+        state_dict.pop(prefix + 'origin_point', None)
+        super(PSN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, coordinate: Tensor, feature: Tensor, train: bool = False) -> Tuple[Tensor, Tensor]:
         """
@@ -185,88 +242,150 @@ class PSN(nn.Module):
 
         assert self.s < m, "The number to sample must less than input points !"
 
-        r = torch.cdist(coordinate, self.origin_point, 2).squeeze_()
-        th = torch.acos(coordinate[:, :, 2] / r)
-        fi = torch.atan2(coordinate[:, :, 1], coordinate[:, :, 0])
-
-        coordinate2 = torch.cat([coordinate, th.unsqueeze_(2), fi.unsqueeze_(2)], -1)
+        coordinate2 = spherical_augment(coordinate)  # [B, m, 5]
 
         x = coordinate2
 
-        # BatchNorm must be Channel First, while Linear is Channel Last,
-        # Therefore transpose to Channel First for BatchNorm after MLP.
-        for i in range(len(self.mlp_convs) - 1):
-            x = F.relu(self.mlp_bns[i](self.mlp_convs[i](x).transpose(2, 1))).transpose(2, 1)
+        # The MLP and the scoring Linear may run in bfloat16,
+        # the coordinates, the scores and the gumbel softmax below stay in float32.
+        # torch.autocast is only entered when asked, it requires PyTorch 1.10.
+        if self.mixed_precision:
+            precision = torch.autocast(device_type=coordinate.device.type, dtype=torch.bfloat16)
+        else:
+            precision = nullcontext()
+        with precision:
+            # Linear and BatchNorm both run Channel Last, no transpose between layers.
+            for i in range(len(self.mlp_convs) - 1):
+                x = F.relu(self.mlp_bns[i](self.mlp_convs[i](x)))
+
+            if self._use_keops(m):
+                # Too many scores to materialize, KeOps reduces them over m in tiles
+                grouped_indices, grouped_scores = keops_score_and_topk(
+                    self.mlp_convs[-1], x, self.n, self.global_feature)    # [B, s, n]
+                Q = None
+            else:
+                if self.global_feature:
+                    # The max feature is added once per channel instead of repeated m times
+                    x = linear_with_global_feature(self.mlp_convs[-1], x).transpose(1, 2)   # [B,s,m]
+                else:
+                    x = self.mlp_convs[-1](x).transpose(1, 2)   # [B,s,m]
+
+                # Sigmoid is monotonic, so topk on the raw scores picks the same indices.
+                grouped_scores, grouped_indices = torch.topk(input=x, k=self.n, dim=2)    # [B, s, n]
+                Q = x.float()  # [B, s, m] sigmoid is only applied for gumbel softmax
+        if self.debug and not torch.jit.is_scripting():
+            # Ratio of distinct grouped points to input points, averaged over the batch.
+            flattened_tensor = torch.flatten(grouped_indices, start_dim=1, end_dim=-1)  # [B, s*n]
+            covered = torch.zeros(flattened_tensor.shape[0], m, dtype=torch.bool, device=flattened_tensor.device)
+            covered.scatter_(1, flattened_tensor, True)
+            unique_num = covered.sum(dim=1).float().mean() / m
+            print()
+            print("Report on unique num: ")
+            print(unique_num)
+            print("---------------------")
 
-        if self.global_feature:
-            max_feature = torch.max(x, 1, keepdim=True)[0]  # [B, 1, mlp[-1]]
-            max_feature = max_feature.repeat(1, m, 1)   # [B, m, mlp[-1]]
-            x = torch.cat([x, max_feature], 2)  # [B, m, mlp[-1] * 2]
-
-        x = self.mlp_convs[-1](x).transpose(1, 2)   # [B,s,m]
-
-        Q = torch.sigmoid(x)  # [B, s, m]
-        #print("Q and Q.shape: ---------------------")
-        #print(Q)
-        #print(Q.shape)
-        #print("------ dim0:")
-        #print(torch.sum(Q,0))
-        #print("-----dim 1:")
-        #print(torch.sum(Q,1))
-        #print("-----dim2")
-        #print(torch.sum(Q,2))
-        #print("---------------------")
-
-
-        _, grouped_indices = torch.topk(input=Q, k=self.n, dim=2)    # [B, s, n]
-        grouped_indices2 = grouped_indices.clone().detach()
-        unique_num = []
-        flattened_tensor = torch.flatten(grouped_indices2, start_dim=1, end_dim=-1)
-        for i in range(grouped_indices2.shape[0]):
-          unique1, _ = torch.unique(flattened_tensor[i], dim = 0, return_counts=True, sorted = False)
-          unique_num.append(unique1.shape[0]/m)
-        
-        unique_num = torch.mean(torch.Tensor(unique_num))
-        print()
-        print("Report on unique num: ")
-        print(unique_num)
-        print("---------------------")
-        
-
-          
-
-
-        #print("report index points :")
-        #print("----------------")
-        #print(grouped_indices.shape)
         grouped_points = index_points(coordinate, grouped_indices)  # [B,s,n,3]
-        #print(grouped_points.shape)
-        #print("------------------")
         if feature is not None:
             grouped_feature = index_points(feature, grouped_indices)  # [B,s,n,d]
             if not train:
                 sampled_points = grouped_points[:, :, 0, :]  # [B,s,3]
                 sampled_feature = grouped_feature[:, :, 0, :]  # [B,s,d]
             else:
-                # Q = gumbel_softmax_sample(Q)  # [B, s, m]
-                # [B, s, m] Using the Gumbel Softmax function included in PyTorch
-                Q = F.gumbel_softmax(Q, self.temperature, True)
-                sampled_points = torch.matmul(Q, coordinate)  # [B,s,3]
-                sampled_feature = torch.matmul(Q, feature)  # [B,s,d]
-                grouped_feature[:, :, 0, :] = sampled_feature
+                # Gumbel softmax restricted to the n candidates of every sampled point,
+                # the hard one-hot is applied by straight_through_gather
+                W = F.gumbel_softmax(torch.sigmoid(grouped_scores.float()), self.temperature)  # [B, s, n]
+                sampled_points = straight_through_gather(W, grouped_points)  # [B,s,3]
+                sampled_feature = straight_through_gather(W, grouped_feature)  # [B,s,d]
+                # grouped_feature is not written in place, sampled_feature was gathered from it
+                grouped_feature = torch.cat([sampled_feature.unsqueeze(2), grouped_feature[:, :, 1:, :]], 2)
         else:
             if not train:
                 sampled_points = grouped_points[:, :, 0, :]  # [B,s,3]
                 sampled_feature = None  # [B,s,d]
             else:
-                # Q = gumbel_softmax_sample(Q)  # [B, s, m]
-                Q = F.gumbel_softmax(Q, self.temperature, True)  # [B, s, m]
-                sampled_points = torch.matmul(Q, coordinate)  # [B,s,3]
+                W = F.gumbel_softmax(torch.sigmoid(grouped_scores.float()), self.temperature)  # [B, s, n]
+                sampled_points = straight_through_gather(W, grouped_points)  # [B,s,3]
                 sampled_feature = None
             grouped_feature = None
 
         return sampled_points, grouped_points, sampled_feature, grouped_feature, Q
 
+    def _use_keops(self, m: int) -> bool:
+        """
+        Whether the scores of m points are too many to materialize and KeOps is available.
+        """
+        return m * self.s > KEOPS_MIN_SCORES and keops_available()
+
+    def forward_compiled(self, coordinate: Tensor, feature: Tensor, train: bool = False) -> Tuple[Tensor, Tensor]:
+        """
+        Forward propagation of Point Structuring Net compiled as a single graph by torch.compile.
+        Each layer, value of train and number of points is compiled once at its first call,
+        the batch size is dynamic so that a short last batch reuses the same graph.
+        Falls back to forward with debug enabled or on the KeOps path, which cannot be traced,
+        and once torch.compile hits its recompile limit (torch._dynamo.config.recompile_limit, 8 by default).
+
+        Args:
+            coordinate: input points position data, [B, m, 3]
+            feature: input points feature, [B, m, d]
+        Returns:
+            the same as forward
+        """
+        key = (train, self.training, self.mixed_precision, coordinate.shape[1:], coordinate.dtype, coordinate.device,
+               None if feature is None else (feature.shape[2], feature.dtype))
+        if self.debug or key in self._eager_keys or self._use_keops(coordinate.shape[1]):
+            return self.forward(coordinate, feature, train)
+        mark_batch_dynamic(coordinate)
+        if feature is not None:
+            mark_batch_dynamic(feature)
+        try:
+            return compiled_psn_forward(self, coordinate, feature, train)
+        except RECOMPILE_LIMIT_ERRORS:
+            # All layers share the graphs of PSN.forward, those beyond the limit run eagerly
+            # and are not tried again, every failed attempt is logged and checks all guards.
+            self._eager_keys.add(key)
+            return self.forward(coordinate, feature, train)
+
+    def forward_graphed(self, coordinate: Tensor, feature: Tensor = None) -> Tuple[Tensor, Tensor]:
+        """
+        Inference forward propagation of Point Structuring Net replayed from a CUDA graph.
+        The graph is captured at the first call and captured again whenever the input shapes change.
+        Falls back to forward when not in eval mode, on CPU, with debug enabled,
+        or on the KeOps path, whose kernels cannot be captured.
+
+        Args:
+            coordinate: input points position data, [B, m, 3]
+            feature: input points feature, [B, m, d]
+        Returns:
+            the same as forward, the tensors are static buffers overwritten by the next call
+        """
+        if self.training or self.debug or not coordinate.is_cuda or self._use_keops(coordinate.shape[1]):
+            return self.forward(coordinate, feature)
+
+        key = (coordinate.shape, coordinate.dtype, coordinate.device,
+               None if feature is None else (feature.shape, feature.dtype), self.mixed_precision)
+        if self._graph_key != key:
+            self._static_coordinate = coordinate.clone()
+            self._static_feature = None if feature is None else feature.clone()
+
+            # Warm up on a side stream before capture, as required by CUDA graphs
+            stream = torch.cuda.Stream(device=coordinate.device)
+            stream.wait_stream(torch.cuda.current_stream(coordinate.device))
+            with torch.cuda.stream(stream), torch.no_grad():
+                for _ in range(3):
+                    self.forward(self._static_coordinate, self._static_feature)
+            torch.cuda.current_stream(coordinate.device).wait_stream(stream)
+
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.no_grad(), torch.cuda.graph(self._graph):
+                self._static_output = self.forward(self._static_coordinate, self._static_feature)
+            self._graph_key = key
+
+        self._static_coordinate.copy_(coordinate)
+        if feature is not None:
+            self._static_feature.copy_(feature)
+        self._graph.replay()
+        return self._static_output
+
 
 class PSNRadius(nn.Module):
     """
@@ -339,35 +458,26 @@ class PSNRadius(nn.Module):
             x = F.relu(self.mlp_bns[i](self.mlp_convs[i](x)))
 
         if self.global_feature:
-            max_feature = torch.max(x, 2, keepdim=True)[0]
-            max_feature = max_feature.repeat(1, 1, m)   # [B, mlp[-1], m]
-            x = torch.cat([x, max_feature], 1)  # [B, mlp[-1] * 2, m]
-
-        x = self.mlp_convs[-1](x)   # [B,s,m]
+            # The max feature is added once per channel instead of repeated m times
+            x = conv1d_with_global_feature(self.mlp_convs[-1], x)   # [B,s,m]
+        else:
+            x = self.mlp_convs[-1](x)   # [B,s,m]
 
         Q = self.softmax(x)  # [B, s, m]
 
-        _, indices = torch.sort(input=Q, dim=2, descending=True)    # [B, s, m]
-
-        grouped_indices = indices[:, :, 0:self.n]   # [B, s, n]
+        _, grouped_indices = torch.topk(input=Q, k=self.n, dim=2)   # [B, s, n]
 
-        sampled_indices = indices[:, :, 0]  # [B, s]
+        sampled_indices = grouped_indices[:, :, 0]  # [B, s]
 
         # function C(x)
         # you may replace C(x) by your heuristic condition
-        sampled_coordinate = torch.unsqueeze(index_points(
-            coordinate, sampled_indices), dim=2)  # [B, s, 1, 3]
+        sampled_coordinate = index_points(
+            coordinate, sampled_indices)  # [B, s, 3]
         grouped_coordinate = index_points(
-            coordinate, grouped_indices)  # [B, s, m, 3]
+            coordinate, grouped_indices)  # [B, s, n, 3]
 
-        diff = grouped_coordinate - sampled_coordinate
-        diff = diff ** 2
-        diff = torch.sum(diff, dim=3)  # [B, s, m]
-        mask = diff > self.radius ** 2
-
-        sampled_indices_expand = torch.unsqueeze(
-            sampled_indices, dim=2).repeat(1, 1, self.n)  # [B, s, n]
-        grouped_indices[mask] = sampled_indices_expand[mask]
+        grouped_indices = radius_mask_fill(
+            grouped_indices, grouped_coordinate, sampled_coordinate, sampled_indices, self.radius ** 2)  # [B, s, n]
         # function C(x) end
 
         return sampled_indices, grouped_indices
@@ -419,6 +529,8 @@ class PSNMSG(nn.Module):
 
         self.s = num_to_sample
         self.msg_n = msg_n
+        # The largest scale is grouped once, the smaller scales are its prefixes.
+        self.n = max(msg_n)
 
     def forward(self, coordinate: Tensor, feature: Tensor, train: bool = False) -> Tuple[Tensor, Tensor]:
         """
@@ -440,42 +552,42 @@ class PSNMSG(nn.Module):
             x = F.relu(self.mlp_bns[i](self.mlp_convs[i](x)))
 
         if self.global_feature:
-            max_feature = torch.max(x, 2, keepdim=True)[0]
-            max_feature = max_feature.repeat(1, 1, m)   # [B, mlp[-1], m]
-            x = torch.cat([x, max_feature], 1)  # [B, mlp[-1] * 2, m]
-
-        x = self.mlp_convs[-1](x)   # [B,s,m]
-
-        Q = torch.sigmoid(x)  # [B, s, m]
+            # The max feature is added once per channel instead of repeated m times
+            x = conv1d_with_global_feature(self.mlp_convs[-1], x)   # [B,s,m]
+        else:
+            x = self.mlp_convs[-1](x)   # [B,s,m]
 
         _, grouped_indices = torch.topk(
-            input=Q, k=self.n, dim=2)    # [B, s, n]
-        # grouped_points = index_points(coordinate, grouped_indices)  #[B,s,n,3]
+            input=x, k=self.n, dim=2)    # [B, s, n]
+        Q = x  # [B, s, m] sigmoid is only applied for gumbel softmax
+        # Every scale is a prefix of the largest one, so index once and slice.
+        grouped_points = index_points(coordinate, grouped_indices)  # [B,s,n,3]
         grouped_points_msg = []
         for n in self.msg_n:
-            grouped_points_msg.append(index_points(
-                coordinate, grouped_indices)[:, :, :n, :])
+            grouped_points_msg.append(grouped_points[:, :, :n, :])
         if feature is not None:
+            grouped_feature = index_points(feature, grouped_indices)  # [B,s,n,d]
             grouped_feature_msg = []
             for n in self.msg_n:
-                grouped_feature_msg.append(index_points(
-                    feature, grouped_indices)[:, :, :n, :])
+                grouped_feature_msg.append(grouped_feature[:, :, :n, :])
             if not train:
                 sampled_points = grouped_points_msg[0][:, :, 0, :]  # [B,s,3]
                 # [B,s,d]
                 sampled_feature = grouped_feature_msg[-1][:, :, 0, :]
             else:
-                Q = gumbel_softmax_sample(Q)  # [B, s, m]
-                sampled_points = torch.matmul(Q, coordinate)  # [B,s,3]
-                sampled_feature = torch.matmul(Q, feature)  # [B,s,d]
-                for n in self.msg_n:
-                    grouped_feature_msg[n][:, :, 0, :] = sampled_feature
+                Q = gumbel_softmax_sample(torch.sigmoid(x))  # [B, s, m]
+                # One matmul reads Q once for both coordinate and feature
+                sampled = torch.matmul(Q, torch.cat([coordinate, feature], 2))  # [B,s,3+d]
+                sampled_points, sampled_feature = torch.split(sampled, [3, feature.shape[2]], 2)  # [B,s,3], [B,s,d]
+                for i in range(len(grouped_feature_msg)):
+                    grouped_feature_msg[i] = torch.cat(
+                        [sampled_feature.unsqueeze(2), grouped_feature_msg[i][:, :, 1:, :]], 2)
         else:
             if not train:
                 sampled_points = grouped_points_msg[0][:, :, 0, :]  # [B,s,3]
                 sampled_feature = None  # [B,s,d]
             else:
-                Q = gumbel_softmax_sample(Q)  # [B, s, m]
+                Q = gumbel_softmax_sample(torch.sigmoid(x))  # [B, s, m]
                 sampled_points = torch.matmul(Q, coordinate)  # [B,s,3]
                 sampled_feature = None
             grouped_feature_msg = None
@@ -483,6 +595,127 @@ class PSNMSG(nn.Module):
         return sampled_points, grouped_points_msg, sampled_feature, grouped_feature_msg
 
 
+def compile_if_available(fn, **kwargs):
+    """
+    Compile fn by torch.compile with kwargs, which is only available since PyTorch 2.0.
+    On older versions fn is returned unchanged.
+    """
+    if hasattr(torch, "compile"):
+        return torch.compile(fn, **kwargs)
+    return fn
+
+
+# The unbound forward is compiled, so that the module is an input of the graph:
+# nothing is stored on a PSN, copies run their own weights, and models stay picklable.
+# Nothing is generated until the first call of PSN.forward_compiled.
+# CUDA graphs are left to forward_graphed, whose outputs are known to be overwritten.
+compiled_psn_forward = compile_if_available(
+    PSN.forward, fullgraph=True, dynamic=None, mode="max-autotune-no-cudagraphs")
+
+# Raised instead of falling back when a fullgraph torch.compile hits its recompile limit,
+# the error is FailOnCacheLimitHit on older versions and does not exist before PyTorch 2.0.
+if hasattr(torch, "compile"):
+    RECOMPILE_LIMIT_ERRORS = tuple(
+        getattr(torch._dynamo.exc, name) for name in ("FailOnRecompileLimitHit", "FailOnCacheLimitHit")
+        if hasattr(torch._dynamo.exc, name))
+else:
+    RECOMPILE_LIMIT_ERRORS = ()
+
+
+def mark_batch_dynamic(x: Tensor) -> None:
+    """
+    Compile the first dimension of x as dynamic instead of specializing every batch size,
+    if torch.compile is available.
+    """
+    if hasattr(torch, "_dynamo") and hasattr(torch._dynamo, "maybe_mark_dynamic"):
+        torch._dynamo.maybe_mark_dynamic(x, 0)
+
+
+@lru_cache(maxsize=None)
+def keops_available() -> bool:
+    """
+    Whether pykeops is installed, checked without importing it.
+    """
+    return importlib.util.find_spec("pykeops") is not None
+
+
+def keops_score_and_topk(linear: nn.Linear, x: Tensor, n: int, global_feature: bool) -> Tuple[Tensor, Tensor]:
+    """
+    Select the n highest scores of the final Linear by KeOps,
+    without materializing the scores of all points, for very large point clouds.
+
+    Input:
+        linear: the final Linear of PSN, with 2 * C input features if global_feature
+        x: Channel Last feature of the last MLP layer, [B, m, C]
+        n: the max number of local area, int
+        global_feature: whether enable global feature, bool
+    Return:
+        grouped_indices: the indices of grouped points, [B, s, n]
+        grouped_scores: the scores of grouped points, [B, s, n]
+    """
+    # Imported here, pykeops is optional and slow to import.
+    from pykeops.torch import LazyTensor
+
+    x = x.float()
+    C = x.shape[2]
+    weight = linear.weight.float()
+    local_weight = weight[:, :C].contiguous()  # [s, C]
+
+    x_j = LazyTensor(x[:, None, :, :])  # [B, 1, m, C]
+    w_i = LazyTensor(local_weight[None, :, None, :])  # [1, s, 1, C]
+    scores = (w_i | x_j)  # [B, s, m], symbolic
+    # The global feature and bias shift every score of a sampled point equally,
+    # so they do not change the selection and are only added to the selected scores.
+    grouped_indices = (-scores).argKmin(n, dim=2).long()  # [B, s, n]
+
+    grouped_scores = torch.sum(index_points(x, grouped_indices) * local_weight[None, :, None, :], dim=3)  # [B, s, n]
+    if global_feature:
+        max_feature = torch.max(x, 1, keepdim=True)[0]  # [B, 1, C]
+        grouped_scores = grouped_scores + F.linear(max_feature, weight[:, C:]).transpose(1, 2)  # [B, s, 1]
+    if linear.bias is not None:
+        grouped_scores = grouped_scores + linear.bias.float()[None, :, None]
+    return grouped_indices, grouped_scores
+
+
+def spherical_augment(coordinate: Tensor) -> Tensor:
+    """
+    Append the polar and azimuthal angles to the cartesian coordinates.
+    The distance to the origin is a norm instead of cdist, the ops are fused by forward_compiled.
+
+    Input:
+        coordinate: input points position data, [B, m, 3]
+    Return:
+        coordinate2: points with spherical angles, [B, m, 5]
+    """
+    x = coordinate[:, :, 0]
+    y = coordinate[:, :, 1]
+    z = coordinate[:, :, 2]
+    r = torch.sqrt(x * x + y * y + z * z)
+    th = torch.acos(z / r)
+    fi = torch.atan2(y, x)
+    return torch.stack([x, y, z, th, fi], dim=-1)
+
+
+def radius_mask_fill(grouped_indices: Tensor, grouped_coordinate: Tensor, sampled_coordinate: Tensor,
+                     sampled_indices: Tensor, radius2: float) -> Tensor:
+    """
+    Replace the grouped points out of radius by the sampled point.
+    torch.where returns new indices instead of the in-place masked assignment.
+
+    Input:
+        grouped_indices: the indices of grouped points, [B, s, n]
+        grouped_coordinate: grouped points position data, [B, s, n, 3]
+        sampled_coordinate: sampled points position data, [B, s, 3]
+        sampled_indices: the indices of sampled points, [B, s]
+        radius2: square of the radius to query, float
+    Return:
+        grouped_indices: the indices of grouped points in radius, [B, s, n]
+    """
+    diff = grouped_coordinate - sampled_coordinate.unsqueeze(2)
+    dist = torch.sum(diff * diff, dim=3)  # [B, s, n]
+    return torch.where(dist > radius2, sampled_indices.unsqueeze(2).expand_as(grouped_indices), grouped_indices)
+
+
 def index_points(points, idx):
     """
 
@@ -492,16 +725,67 @@ def index_points(points, idx):
     Return:
         new_points:, indexed points data, [B, S, C]
     """
-    device = points.device
-    B = points.shape[0]
-    view_shape = list(idx.shape)
-    view_shape[1:] = [1] * (len(view_shape) - 1)
-    repeat_shape = list(idx.shape)
-    repeat_shape[0] = 1
-    batch_indices = torch.arange(B, dtype=torch.long, device=device).view(
-        view_shape).repeat(repeat_shape)
-    new_points = points[batch_indices, idx, :]
-    return new_points
+    B, _, C = points.shape
+    idx_flat = idx.reshape(B, -1, 1).expand(-1, -1, C)  # [B, S, C]
+    new_points = torch.gather(points, 1, idx_flat)
+    return new_points.reshape(list(idx.shape) + [C])
+
+
+def linear_with_global_feature(linear, x):
+    """
+    Linear of the feature concatenated with its global max feature.
+    Equivalent to linear(torch.cat([x, max_feature.repeat(1, m, 1)], 2)),
+    the weight is split so that the max feature is projected once and broadcast.
+
+    Input:
+        linear: Linear with 2 * C input features
+        x: Channel Last feature, [B, m, C]
+    Return:
+        new_x: Channel Last output, [B, m, s]
+    """
+    C = x.shape[2]
+    max_feature = torch.max(x, 1, keepdim=True)[0]  # [B, 1, C]
+    local = F.linear(x, linear.weight[:, :C], linear.bias)  # [B, m, s]
+    return local + F.linear(max_feature, linear.weight[:, C:])  # [B, 1, s] broadcast
+
+
+def conv1d_with_global_feature(conv, x):
+    """
+    1x1 convolution of the feature concatenated with its global max feature.
+    Equivalent to conv(torch.cat([x, max_feature.repeat(1, 1, m)], 1)),
+    the weight is split so that the max feature is projected once and broadcast.
+
+    Input:
+        conv: Conv1d with 2 * C input channels and kernel size 1
+        x: Channel First feature, [B, C, m]
+    Return:
+        new_x: Channel First output, [B, s, m]
+    """
+    C = x.shape[1]
+    max_feature = torch.max(x, 2, keepdim=True)[0]  # [B, C, 1]
+    local = F.conv1d(x, conv.weight[:, :C], conv.bias)  # [B, s, m]
+    return local + F.conv1d(max_feature, conv.weight[:, C:])  # [B, s, 1] broadcast
+
+
+def straight_through_gather(soft, grouped_points):
+    """
+    Straight-through sampling of every local area by a soft sample over its points.
+    The result is the point at the argmax of soft, while the gradient flows to soft
+    as if the soft weighted sum of the points was taken.
+
+    Input:
+        soft: soft sample from the Gumbel-Softmax distribution, [B, S, n]
+        grouped_points: grouped points data, [B, S, n, C]
+    Return:
+        new_points: hard sampled points with the gradient of soft, [B, S, C]
+    """
+    C = grouped_points.shape[-1]
+    hard_indices = soft.argmax(dim=2)[:, :, None, None].expand(-1, -1, 1, C)  # [B, S, 1, C]
+    hard_points = torch.gather(grouped_points, 2, hard_indices).squeeze(2)  # [B, S, C]
+    # Only soft receives the straight-through gradient, points get that of the hard one-hot.
+    soft_points = torch.matmul(soft.unsqueeze(2), grouped_points.detach()).squeeze(2)  # [B, S, C]
+    return hard_points + (soft_points - soft_points.detach())
+
 
 # Gumbel Softmax
 # This version of the code uses Gumbel, which is included in Torch.
@@ -509,14 +793,14 @@ def index_points(points, idx):
 # you can use the following methods instead.
 
 
-def sample_gumbel(shape, eps=1e-20):
-    U = torch.rand(shape)
-    U = U.cuda()
-    return -torch.log(-torch.log(U + eps) + eps)
+def sample_gumbel(shape, device, dtype, eps=1e-20):
+    U = torch.rand(shape, device=device, dtype=dtype)
+    # -log(-log(U + eps) + eps) in place, U is not used elsewhere
+    return U.add_(eps).log_().neg_().add_(eps).log_().neg_()
 
 
 def gumbel_softmax_sample(logits, dim=-1, temperature=0.001):
-    y = logits + sample_gumbel(logits.size())
+    y = logits + sample_gumbel(logits.size(), logits.device, logits.dtype)
     return F.softmax(y / temperature, dim=dim)
 
 
@@ -531,7 +815,7 @@ def gumbel_softmax(logits, temperature=1.0, hard=True):
       If hard=True, then the returned sample will be one-hot, otherwise it will
       be a probabilitiy distribution that sums to 1 across classes
     """
-    y = gumbel_softmax_sample(logits, temperature)
+    y = gumbel_softmax_sample(logits, temperature=temperature)
     if hard:
         y_hard = onehot_from_logits(y)
         #print(y_hard[0], "random")
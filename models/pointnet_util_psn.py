@@ -55,16 +55,10 @@ def index_points(points, idx):
     Return:
         new_points:, indexed points data, [B, S, C]
     """
-    device = points.device
-    B = points.shape[0]
-    view_shape = list(idx.shape)
-    view_shape[1:] = [1] * (len(view_shape) - 1)
-    repeat_shape = list(idx.shape)
-    repeat_shape[0] = 1
-    batch_indices = torch.arange(B, dtype=torch.long, device=device).view(
-        view_shape).repeat(repeat_shape)
-    new_points = points[batch_indices, idx, :]
-    return new_points
+    B, _, C = points.shape
+    idx_flat = idx.reshape(B, -1, 1).expand(-1, -1, C)  # [B, S, C]
+    new_points = torch.gather(points, 1, idx_flat)
+    return new_points.reshape(list(idx.shape) + [C])
 
 
 def sample_and_group_psn(npoint, sampled_points, grouped_points, sampled_feature, grouped_feature, nsample):